@@ -1,12 +1,19 @@
 import os
 import time
 import re
+import hashlib
+import queue
+import asyncio
+import threading
+import importlib.util
 import streamlit as st
-from openai import OpenAI
-from dotenv import load_dotenv
 
-# Load .env if present
-load_dotenv()
+from constants import FULL_FILE_SECTIONS, SAMPLES, SECTION_PROMPTS, SYSTEM_PROMPT, SYSTEM_PROMPT_VERSION
+
+# Load .env if present (only needed when the key isn't already in the environment)
+if not os.environ.get("OPENAI_API_KEY"):
+    from dotenv import load_dotenv
+    load_dotenv()
 
 # ----------------------------
 # Configuration & Secrets
@@ -16,17 +23,25 @@ if not OPENAI_API_KEY:
     st.error("⚠️ OPENAI_API_KEY missing. Add it as an environment variable or in .streamlit/secrets.toml and restart.")
     st.stop()
 
-# Initialize OpenAI client (v1+)
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Initialize OpenAI client (v1+) once per process so the HTTP pool survives reruns.
+# openai (httpx, pydantic, anyio) is imported on the first request, not at startup.
+@st.cache_resource
+def get_openai_client():
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(api_key=OPENAI_API_KEY)
+
+# The async client's connections are bound to the loop that opened them, so every
+# request runs on one long-lived background loop instead of a fresh asyncio.run() loop.
+@st.cache_resource
+def get_event_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="openai-event-loop", daemon=True).start()
+    return loop
 
 # ----------------------------
-# Optional: ACE editor availability
+# Optional: ACE editor availability (imported where the editor is rendered, falling back to a text area)
 # ----------------------------
-try:
-    from streamlit_ace import st_ace
-    ACE_AVAILABLE = True
-except Exception:
-    ACE_AVAILABLE = False
+ACE_AVAILABLE = importlib.util.find_spec("streamlit_ace") is not None
 
 # ----------------------------
 # App UI
@@ -40,64 +55,47 @@ with st.sidebar:
     language = st.selectbox("Programming language", ["python", "javascript", "typescript", "go", "java", "csharp"], index=0)
     model = st.selectbox("Model", ["gpt-4o-mini", "gpt-4o", "gpt-4o-realtime-preview", "gpt-4"], index=0)
     temperature = st.slider("Temperature", 0.0, 1.0, 0.15)
-    max_tokens = st.slider("Max response tokens", 128, 1500, 512)
+    max_tokens = st.slider("Max response tokens (per section)", 128, 1500, 512)
     auto_mode = st.checkbox("Enable auto-suggest", value=True)
     idle_threshold = st.slider("Idle seconds before suggestion", 1, 6, 2)
     show_diff = st.checkbox("Show unified diff/patch", value=True)
     st.markdown("---")
     st.caption("Editor theme: dark. If streamlit-ace is not installed the app uses a fallback text area.")
 
-# Sample starters
-SAMPLES = {
-    "python": """def fetch_users(db):
-    users = db.query('SELECT * FROM users')
-    for u in users:
-        print(u.name)
-""",
-    "javascript": """async function getUsers(req, res) {
-  const users = await db.find('users')
-  res.send(users)
-}
-""",
-    "typescript": """async function fetchData(url: string): Promise<any> {
-  const res = await fetch(url)
-  return res.json()
-}
-""",
-    "go": """package main
-
-func Sum(a int, b int) int {
-    return a + b
-}
-""",
-    "java": """public class Hello {
-  public static void main(String[] args) {
-    System.out.println("Hello World");
-  }
-}
-""",
-    "csharp": """using System;
-class Program {
-  static void Main() {
-    Console.WriteLine("Hello World");
-  }
-}
-""",
-}
+# Suggestion bookkeeping compares short digests of the editor content instead of full strings
+def code_digest(code: str) -> bytes:
+    return hashlib.blake2b((code or "").encode(), digest_size=8).digest()
+
+def set_editor_content(code: str):
+    st.session_state.editor_content = code
+    st.session_state.editor_len = len(code or "")
+    st.session_state.editor_hash = code_digest(code)
 
 # Initialize session state keys safely
 if "editor_content" not in st.session_state:
-    st.session_state.editor_content = SAMPLES.get("python", "")
+    set_editor_content(SAMPLES.get("python", ""))
 if "last_edit_ts" not in st.session_state:
-    st.session_state.last_edit_ts = time.time()
+    st.session_state.last_edit_ts = time.monotonic_ns()
 if "manual_trigger" not in st.session_state:
     st.session_state.manual_trigger = False
 if "last_suggested_code" not in st.session_state:
     st.session_state.last_suggested_code = None
+if "last_suggested_code_norm" not in st.session_state:
+    st.session_state.last_suggested_code_norm = None
+if "last_suggested_hash" not in st.session_state:
+    st.session_state.last_suggested_hash = None
+if "last_skipped_state_key" not in st.session_state:
+    st.session_state.last_skipped_state_key = None
 if "suggestion_md" not in st.session_state:
     st.session_state.suggestion_md = None
+if "console_text" not in st.session_state:
+    st.session_state.console_text = None
 if "suggested_refactor_code" not in st.session_state:
     st.session_state.suggested_refactor_code = None
+if "ghost_preview" not in st.session_state:
+    st.session_state.ghost_preview = ""
+if "md_parse_cache" not in st.session_state:
+    st.session_state.md_parse_cache = {}
 
 # Layout: left editor, right suggestions + console
 left_col, right_col = st.columns([1.3, 1])
@@ -108,7 +106,14 @@ with left_col:
 
     # Controlled editor value: show session_state.editor_content (keeps Apply Suggestion working)
     initial_code = st.session_state.editor_content or SAMPLES.get(language, "")
+    st_ace = None
     if ACE_AVAILABLE:
+        try:
+            from streamlit_ace import st_ace
+        except Exception:
+            # installed but broken (bad dependency / version mismatch): use the fallback editor
+            st_ace = None
+    if st_ace:
         code = st_ace(value=initial_code, language=language, theme="monokai", key="ace", height=editor_height)
     else:
         code = st.text_area("Code", value=initial_code, height=editor_height, key="fallback_editor")
@@ -116,12 +121,14 @@ with left_col:
     # If user changed language and editor was a sample, optionally replace content
     # (Don't override user's custom code if they've typed something)
     if st.session_state.editor_content == "" and SAMPLES.get(language):
-        st.session_state.editor_content = SAMPLES[language]
+        set_editor_content(SAMPLES[language])
 
     # Save to session state and detect edits
-    if code != st.session_state.editor_content:
-        st.session_state.editor_content = code
-        st.session_state.last_edit_ts = time.time()
+    # length is a free pre-filter; equal lengths fall back to a C-level string compare, and the
+    # digest is only recomputed (inside set_editor_content) when the text really changed
+    if len(code or "") != st.session_state.editor_len or code != st.session_state.editor_content:
+        set_editor_content(code)
+        st.session_state.last_edit_ts = time.monotonic_ns()
 
     # Editor actions
     col_apply, col_manual, col_clear = st.columns([1,1,1])
@@ -130,65 +137,181 @@ with left_col:
     if col_apply.button("Apply suggestion"):
         suggested = st.session_state.get("suggested_refactor_code")
         if suggested:
-            st.session_state.editor_content = suggested
+            set_editor_content(suggested)
             # keep last edit ts updated so autosuggest doesn't immediately retrigger
-            st.session_state.last_edit_ts = time.time()
+            st.session_state.last_edit_ts = time.monotonic_ns()
             st.rerun()
     if col_clear.button("Clear suggestion"):
         st.session_state.suggestion_md = None
+        st.session_state.console_text = None
         st.session_state.suggested_refactor_code = None
+        st.session_state.ghost_preview = ""
+        st.session_state.md_parse_cache.clear()
 
 with right_col:
     st.subheader("AI Suggestions")
+    # Suggestions and proposed tests share one placeholder so each update is a single write
     suggestion_box = st.empty()
-    st.subheader("Console / Proposed Tests")
-    console_box = st.empty()
+
+def render_suggestion_panel(md=None, console_text=None):
+    with suggestion_box.container():
+        if md:
+            st.markdown(md)
+        st.subheader("Console / Proposed Tests")
+        if console_text:
+            st.code(console_text)
+
+# Reruns without a new suggestion redraw the last one from session state (no re-parse/re-join)
+render_suggestion_panel(st.session_state.suggestion_md, st.session_state.console_text)
 
 # Helpers
 # regex to capture fenced code blocks with optional language
 CODE_BLOCK_RE = re.compile(r"```(?:[a-zA-Z0-9_+-]*)?\n([\s\S]*?)\n```")
+# headings that introduce the tests section (case-insensitive)
+TESTS_HEADING_RE = re.compile(r"(?:^|\n)\s*(?:#{1,6}\s*)?(?:proposed test cases|test cases|tests|proposed tests)\b", re.IGNORECASE)
+# next markdown heading, used to bound the tests section
+NEXT_HEADING_RE = re.compile(r"\n\s*#{1,6}\s+")
+# bullet line (-, * or numbered); group 1 is the item text without the marker
+BULLET_RE = re.compile(r"^(?:[-*]|\d+\.)\s*(.+)$")
 
 def extract_code_block(md: str):
-    if not md:
+    # plain substring check is far cheaper than running the regex on fence-free markdown
+    if not md or "```" not in md:
         return None
     m = CODE_BLOCK_RE.search(md)
     return m.group(1) if m else None
 
-# Build system prompt
-SYSTEM_PROMPT = (
-    "You are The AI Pair Engineer — a senior software engineer assistant.\n"
-    "For the provided code, return the following in Markdown:\n"
-    "- Summary (1-2 lines).\n"
-    "- 3-6 design flaws or code smells.\n"
-    "- 3 actionable inline auto-suggestions (line-level, short).\n"
-    "- 3-6 proposed test cases (including edge/negative cases).\n"
-    "- Optional: a refactored version of the code wrapped in a fenced code block using the language.\n"
-    "Also include small completion snippets where helpful (<= 10 lines). Be concise and practical."
-)
-
-# Call OpenAI
-def call_pair_engineer(code_text: str, language: str):
+# Call OpenAI: one streamed request per section, run concurrently so latency is the
+# slowest section rather than the sum. `on_update` receives the accumulated markdown.
+STREAM_FLUSH_INTERVAL = 0.05  # seconds between incremental UI renders
+
+async def _stream_section(section: str, client, code_text: str, language: str, model: str, temperature: float,
+                          max_tokens: int, updates: queue.Queue):
     messages = [
-        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "system", "content": SYSTEM_PROMPT + SECTION_PROMPTS[section]},
         {"role": "user", "content": f"Language: {language}\n\nCode:\n```{language}\n{code_text}\n```"},
     ]
+    stream = await client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    usage = None
+    async for chunk in stream:
+        # the final chunk carries usage and has no choices
+        if chunk.usage:
+            usage = chunk.usage
+        if chunk.choices and chunk.choices[0].delta.content:
+            updates.put((section, chunk.choices[0].delta.content))
+    return usage
+
+async def _gather_sections(client, code_text: str, window_text: str, *args):
+    tasks = [
+        asyncio.ensure_future(
+            _stream_section(section, client, code_text if section in FULL_FILE_SECTIONS else window_text, *args)
+        )
+        for section in SECTION_PROMPTS
+    ]
     try:
-        # show a small progress indicator to the user (not blocking)
-        with st.spinner("Contacting OpenAI..."):
-            resp = client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=float(temperature),
-                max_tokens=int(max_tokens),
-            )
-        # Newer OpenAI libs return content in .choices[0].message.content
-        content = None
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        # gather leaves the other sections running when one fails; stop them so no tokens are wasted
+        for task in tasks:
+            task.cancel()
+        raise
+
+def _next_update(updates: queue.Queue, future):
+    # Next (section, delta) from the background loop, or None once every section has finished
+    while True:
         try:
-            content = resp.choices[0].message["content"]
-        except Exception:
-            # fallback for other response shapes
-            content = getattr(resp.choices[0].message, "content", None) or resp.choices[0].text
-        return content
+            return updates.get(timeout=STREAM_FLUSH_INTERVAL)
+        except queue.Empty:
+            if future.done() and updates.empty():
+                return None
+
+# Memo of finished responses, shared by all sessions. It holds plain data only: st.cache_data would
+# record and replay the streaming renders, which target a placeholder that doesn't exist on replay.
+RESPONSE_CACHE_TTL = 24 * 60 * 60  # seconds
+RESPONSE_CACHE_SIZE = 256
+
+@st.cache_resource
+def get_response_cache():
+    # key -> (stored_at, markdown, usage); the lock guards concurrent sessions
+    return {}, threading.Lock()
+
+def _cached_response(key):
+    cache, lock = get_response_cache()
+    with lock:
+        hit = cache.get(key)
+        if hit is None:
+            return None
+        if time.monotonic() - hit[0] > RESPONSE_CACHE_TTL:
+            del cache[key]
+            return None
+        return hit[1], hit[2]
+
+def _store_response(key, markdown: str, usage):
+    cache, lock = get_response_cache()
+    with lock:
+        if key not in cache and len(cache) >= RESPONSE_CACHE_SIZE:
+            # evict the oldest entry (dicts keep insertion order)
+            cache.pop(next(iter(cache)))
+        cache[key] = (time.monotonic(), markdown, usage)
+
+def _stream_pair_engineer(code_text: str, window_text: str, language: str, model: str, temperature: float,
+                          max_tokens: int, on_update=None):
+    # Returns (markdown, usage per section). Deltas are handed over through a queue so all
+    # Streamlit calls stay on the script thread.
+    updates = queue.Queue()
+    future = asyncio.run_coroutine_threadsafe(
+        _gather_sections(get_openai_client(), code_text, window_text, language, model, temperature, max_tokens,
+                         updates),
+        get_event_loop(),
+    )
+    parts = dict.fromkeys(SECTION_PROMPTS, "")
+
+    def render():
+        return "\n\n".join(part for part in parts.values() if part)
+
+    try:
+        # show a small progress indicator only until the first chunk arrives
+        with st.spinner("Contacting OpenAI..."):
+            update = _next_update(updates, future)
+
+        last_flush = time.monotonic()
+        while update is not None:
+            section, delta = update
+            parts[section] += delta
+            now = time.monotonic()
+            if on_update and now - last_flush >= STREAM_FLUSH_INTERVAL:
+                on_update(render())
+                last_flush = now
+            update = _next_update(updates, future)
+
+        # re-raises the first failed section
+        usage = dict(zip(SECTION_PROMPTS, future.result()))
+    finally:
+        # a rerun/stop interrupting this thread must not leave the streams running on the loop
+        future.cancel()
+    # the caller renders the final markdown together with the extracted tests
+    return render(), usage
+
+def call_pair_engineer(code_text: str, language: str, on_update=None, window_text: str = None):
+    # `window_text` (default: the whole file) is what the sections outside FULL_FILE_SECTIONS see
+    window_text = code_text if window_text is None else window_text
+    key = (code_text, window_text, language, model, float(temperature), int(max_tokens), SYSTEM_PROMPT_VERSION)
+    try:
+        cached = _cached_response(key)
+        if cached is None:
+            # failures raise before anything is stored, so they are never cached
+            cached = _stream_pair_engineer(code_text, window_text, language, model, float(temperature),
+                                           int(max_tokens), on_update=on_update)
+            _store_response(key, *cached)
+        markdown, st.session_state.last_usage = cached
+        return markdown or None
     except Exception as e:
         return f"❌ OpenAI request failed:\n{e}"
 
@@ -204,106 +327,193 @@ def extract_test_cases_from_md(md: str, max_items: int = 10):
     if not md:
         return []
 
-    # 1) Strip fenced code blocks (replace with empty string)
-    md_no_code = CODE_BLOCK_RE.sub("", md)
+    # 1) Strip fenced code blocks (replace with empty string); skip the regex when there are no fences
+    md_no_code = CODE_BLOCK_RE.sub("", md) if "```" in md else md
 
-    # 2) Split by headings for tests (case-insensitive)
-    split_pattern = re.compile(r"(?i)(^|\n)\s*(#{1,6}\s*)?(proposed test cases|test cases|tests|proposed tests)\b", re.IGNORECASE)
-    parts = split_pattern.split(md_no_code)
+    # 2) Find the first heading for tests (case-insensitive)
     tests = []
-
-    if len(parts) > 1:
-        # Find the part after the first match (parts is list where matched groups interleave)
-        # We'll search for the first occurrence index that matches our key words
-        # Simpler: find the index of the match using search
-        match = split_pattern.search(md_no_code)
-        if match:
-            start = match.end()
-            # take the substring from that point to next H2/H3 style marker or end
-            following_text = md_no_code[start:]
-            # stop at next significant heading (lines starting with # or '##' or '###' or another section label like '###')
-            next_heading = re.search(r"\n\s*#{1,6}\s+", following_text)
-            section = following_text[: next_heading.start()] if next_heading else following_text
-            # extract bullets lines only
-            for ln in section.splitlines():
-                stripped = ln.strip()
-                if stripped.startswith(("-", "*")) or re.match(r"^\d+\.", stripped):
-                    # remove leading bullet markers and whitespace
-                    cleaned = re.sub(r"^(\-|\*|\d+\.)\s*", "", stripped)
-                    if cleaned:
-                        tests.append(cleaned)
-                    if len(tests) >= max_items:
-                        break
+    match = TESTS_HEADING_RE.search(md_no_code)
+    if match:
+        start = match.end()
+        # stop at next significant heading (lines starting with # or '##' or '###' or another section label like '###');
+        # searched in place from `start` so only the section itself is copied
+        next_heading = NEXT_HEADING_RE.search(md_no_code, start)
+        end = next_heading.start() if next_heading else len(md_no_code)
+        # extract bullets lines only, without their leading markers
+        for ln in md_no_code[start:end].splitlines():
+            m = BULLET_RE.match(ln.strip())
+            if m:
+                tests.append(m.group(1))
+                if len(tests) >= max_items:
+                    break
 
     # Fallback: find any bullet lines outside code fences containing 'test'
     if not tests:
         for ln in md_no_code.splitlines():
-            stripped = ln.strip()
-            if (stripped.startswith(("-", "*")) or re.match(r"^\d+\.", stripped)) and "test" in stripped.lower():
-                cleaned = re.sub(r"^(\-|\*|\d+\.)\s*", "", stripped)
-                if cleaned:
-                    tests.append(cleaned)
+            m = BULLET_RE.match(ln.strip())
+            if m and "test" in m.group(0).lower():
+                tests.append(m.group(1))
                 if len(tests) >= max_items:
                     break
 
     return tests[:max_items]
 
+# Parsed (refactor block, test cases) per suggestion markdown, keyed by digest so session state
+# doesn't hold whole responses. Hits come from response-cache hits (the same markdown again).
+# Functions in this script are redefined on every rerun, so the memo can't be an lru_cache.
+MD_PARSE_CACHE_SIZE = 8
+
+def parse_suggestion(md: str):
+    cache = st.session_state.md_parse_cache
+    key = code_digest(md)
+    parsed = cache.get(key)
+    if parsed is None:
+        parsed = (extract_code_block(md), extract_test_cases_from_md(md))
+        if len(cache) >= MD_PARSE_CACHE_SIZE:
+            # evict the oldest entry (dicts keep insertion order)
+            cache.pop(next(iter(cache)))
+        cache[key] = parsed
+    return parsed
+
+# Prompt window: for long files the review/tests sections only see the lines around the latest edit
+CONTEXT_RADIUS = 80  # lines sent either side of the edit
+
+def window_around_cursor(code: str, cursor_line=None, radius: int = CONTEXT_RADIUS, comment: str = "#") -> str:
+    """
+    Return the lines [cursor_line - radius, cursor_line + radius] with an elision marker for the rest.
+    Without a cursor line, keep the first and last `radius` lines instead.
+    """
+    lines = code.splitlines()
+    if len(lines) <= 2 * radius + 1:
+        return code
+
+    def elided(n):
+        return f"{comment} ... ({n} lines elided) ..."
+
+    if cursor_line is None:
+        return "\n".join(lines[:radius] + [elided(len(lines) - 2 * radius)] + lines[-radius:])
+
+    start = max(0, cursor_line - radius)
+    end = min(len(lines), cursor_line + radius + 1)
+    window = lines[start:end]
+    if start:
+        window.insert(0, elided(start))
+    if end < len(lines):
+        window.append(elided(len(lines) - end))
+    return "\n".join(window)
+
+def first_changed_line(old: str, new: str):
+    # Stand-in for the cursor (st_ace does not report it): first line that differs from `old`
+    if not old:
+        return None
+    old_lines, new_lines = old.splitlines(), new.splitlines()
+    for i, (a, b) in enumerate(zip(old_lines, new_lines)):
+        if a != b:
+            return i
+    return min(len(old_lines), len(new_lines))
+
+# Auto-suggest guards: skip tiny snippets and edits too small to change the analysis
+MIN_CODE_CHARS = 30
+MIN_EDIT_CHARS = 20
+WHITESPACE_RE = re.compile(r"\s+")
+
+def changed_chars(old: str, new: str) -> int:
+    # Size of the edited region: what's left after the prefix and suffix shared by both strings
+    prefix = len(os.path.commonprefix([old, new]))
+    suffix = len(os.path.commonprefix([old[prefix:][::-1], new[prefix:][::-1]]))
+    return max(len(old), len(new)) - prefix - suffix
+
+# Everything that can change a suggestion; reruns/ticks with an identical key have nothing new to evaluate
+state_key = (language, model, round(temperature, 3), max_tokens, auto_mode, idle_threshold, show_diff,
+             st.session_state.editor_hash)
+
 # Generate suggestion and update UI
-def generate_suggestion_and_update():
-    current = st.session_state.editor_content
+def generate_suggestion_and_update(manual: bool = False):
+    # local alias for the session state proxy, read/written throughout below
+    ss = st.session_state
+    current = ss.editor_content
+    current_hash = ss.editor_hash
     # Prevent empty or unchanged calls
-    if not current or st.session_state.get("last_suggested_code") == current:
+    if not current or ss.get("last_suggested_hash") == current_hash:
         return
-
-    suggestion_md = call_pair_engineer(current, language)
+    # Nothing changed since this exact state was last declined: skip re-normalising the code every tick
+    if not manual and ss.last_skipped_state_key == state_key:
+        return
+    # Whitespace-only edits never change the suggestion
+    norm = WHITESPACE_RE.sub(" ", current).strip()
+    last_norm = ss.get("last_suggested_code_norm")
+    if norm == last_norm:
+        ss.last_skipped_state_key = state_key
+        return
+    # Auto mode waits for a meaningful amount of code/change; "Suggest now" always goes through
+    if not manual:
+        if len(current) < MIN_CODE_CHARS or (last_norm is not None and changed_chars(last_norm, norm) < MIN_EDIT_CHARS):
+            ss.last_skipped_state_key = state_key
+            return
+
+    cursor_line = first_changed_line(ss.get("last_suggested_code"), current)
+    # review/tests see a window around the edit; the refactor section always gets the whole file
+    window_code = window_around_cursor(current, cursor_line, comment="#" if language == "python" else "//")
+    suggestion_md = call_pair_engineer(current, language, on_update=render_suggestion_panel, window_text=window_code)
     # In case of error text, suggestion_md may be an error string; display it.
-    st.session_state.suggestion_md = suggestion_md
-    suggestion_box.markdown(suggestion_md if suggestion_md else "_No suggestion returned._")
+    ss.suggestion_md = suggestion_md
 
-    # extract refactored code block if provided
-    ref = extract_code_block(suggestion_md) if suggestion_md else None
+    # extract refactored code block (if provided) and test cases
+    ref, tests = parse_suggestion(suggestion_md or "")
     if ref:
-        st.session_state.suggested_refactor_code = ref
+        ss.suggested_refactor_code = ref
+    # first few lines of the refactor snippet, rendered as the ghost preview on every rerun
+    ss.ghost_preview = "\n".join(ref.splitlines()[:6]) if ref else ""
 
-    # extract test cases
-    tests = extract_test_cases_from_md(suggestion_md or "")
+    # joined once per suggestion; later reruns render the stored string
     console_text = "\n".join(f"- {t}" for t in tests) if tests else "(No explicit test cases found in suggestions.)"
-    console_box.code(console_text)
+    ss.console_text = console_text
+    render_suggestion_panel(suggestion_md if suggestion_md else "_No suggestion returned._", console_text)
 
     # update last suggested content marker
-    st.session_state.last_suggested_code = current
+    ss.last_suggested_code = current
+    ss.last_suggested_hash = current_hash
+    ss.last_suggested_code_norm = norm
+    # a declined state is only meaningful relative to the suggestion it was compared against
+    ss.last_skipped_state_key = None
 
 # Triggers: manual or auto
 manual = st.session_state.get("manual_trigger", False)
 if manual:
     st.session_state.manual_trigger = False
-    generate_suggestion_and_update()
-
-# Auto-mode: check idle time and don't spam
-if auto_mode:
-    last_edit = st.session_state.get("last_edit_ts", None)
-    if last_edit:
-        idle = time.time() - last_edit
-        # Only trigger if idle threshold reached and content changed since last suggestion
-        if idle >= idle_threshold and st.session_state.get("last_suggested_code") != st.session_state.editor_content:
-            generate_suggestion_and_update()
-
-# Ghost preview: show first few lines of refactor snippet
-if st.session_state.get("suggestion_md"):
-    ghost = extract_code_block(st.session_state.suggestion_md) or ""
-    ghost_preview = "\n".join(ghost.splitlines()[:6]) if ghost else ""
-    if ghost_preview:
-        st.info("Ghost suggestion (preview):")
-        st.code(ghost_preview, language=language)
+    generate_suggestion_and_update(manual=True)
+
+# Auto-mode + ghost preview run in a fragment so the idle check ticks on its own
+# without re-executing the whole script (sidebar, samples, session-state init).
+@st.fragment(run_every="1s" if auto_mode else None)
+def autosuggest_fragment():
+    ss = st.session_state
+    if auto_mode:
+        last_edit = ss.last_edit_ts
+        if last_edit:
+            idle = (time.monotonic_ns() - last_edit) / 1e9
+            # Only trigger if idle threshold reached and content changed since last suggestion
+            if idle >= idle_threshold and ss.get("last_suggested_hash") != ss.editor_hash:
+                generate_suggestion_and_update()
+
+    # Ghost preview: show first few lines of refactor snippet (extracted once per suggestion)
+    if ss.get("suggestion_md"):
+        ghost_preview = ss.get("ghost_preview")
+        if ghost_preview:
+            st.info("Ghost suggestion (preview):")
+            st.code(ghost_preview, language=language)
+
+autosuggest_fragment()
 
 # Debug
 with st.expander("Debug / State"):
     st.write("Model:", model)
     st.write("Language:", language)
-    st.write("Last edit ts:", st.session_state.get("last_edit_ts"))
+    st.write("Last edit ts (monotonic ns):", st.session_state.get("last_edit_ts"))
     st.write("Last suggested code present:", bool(st.session_state.get("last_suggested_code")))
     st.write("Suggestion present:", bool(st.session_state.get("suggestion_md")))
     st.write("Refactor snippet present:", bool(st.session_state.get("suggested_refactor_code")))
+    st.write("Last token usage:", st.session_state.get("last_usage"))
 
 # End of app - lightweight instructions
 st.markdown("---")
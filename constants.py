@@ -0,0 +1,76 @@
+"""Static data for the AI Pair Engineer app.
+
+Kept out of the Streamlit script so it is built once per process on import
+instead of on every rerun.
+"""
+from types import MappingProxyType
+
+# Sample starters (read-only: shared by every session)
+SAMPLES = MappingProxyType({
+    "python": """def fetch_users(db):
+    users = db.query('SELECT * FROM users')
+    for u in users:
+        print(u.name)
+""",
+    "javascript": """async function getUsers(req, res) {
+  const users = await db.find('users')
+  res.send(users)
+}
+""",
+    "typescript": """async function fetchData(url: string): Promise<any> {
+  const res = await fetch(url)
+  return res.json()
+}
+""",
+    "go": """package main
+
+func Sum(a int, b int) int {
+    return a + b
+}
+""",
+    "java": """public class Hello {
+  public static void main(String[] args) {
+    System.out.println("Hello World");
+  }
+}
+""",
+    "csharp": """using System;
+class Program {
+  static void Main() {
+    Console.WriteLine("Hello World");
+  }
+}
+""",
+})
+
+# Build system prompt (shared prefix of every section request)
+SYSTEM_PROMPT = (
+    "You are The AI Pair Engineer — a senior software engineer assistant.\n"
+    "For the provided code, return only the section requested below, in Markdown. Be concise and practical.\n"
+)
+
+# One focused prompt per section; the sections are requested concurrently and shown in this order
+SECTION_PROMPTS = MappingProxyType({
+    "review": (
+        "Return, without fenced code blocks:\n"
+        "- '## Summary' (1-2 lines).\n"
+        "- '## Design Flaws': 3-6 design flaws or code smells.\n"
+        "- '## Inline Suggestions': 3 actionable inline auto-suggestions (line-level, short)."
+    ),
+    "tests": (
+        "Return, without fenced code blocks:\n"
+        "- '## Proposed Test Cases': 3-6 bullet points (including edge/negative cases)."
+    ),
+    "refactor": (
+        "Return:\n"
+        "- '## Refactored Code': a refactored version of the code wrapped in a fenced code block using the language.\n"
+        "- Optionally, small completion snippets where helpful (<= 10 lines), after the refactored code."
+    ),
+})
+
+# Sections that always see the whole file (a refactor must be applicable to the editor);
+# the others get a window around the latest edit for long files
+FULL_FILE_SECTIONS = frozenset({"refactor"})
+
+# Bump whenever SYSTEM_PROMPT or SECTION_PROMPTS change so cached responses are invalidated
+SYSTEM_PROMPT_VERSION = 2